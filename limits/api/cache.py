@@ -0,0 +1,54 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class NonceCache(object):
+    """
+    Remember the errors returned for the nonces that can't be used anymore, so
+    that a client resending one of them gets the same errors back without
+    reaching Braintree.
+
+    The cache is bounded: it keeps the most recently used customers, the most
+    recent nonces of each customer, and every entry expires after a timeout.
+    """
+
+    def __init__(self, max_customers, max_nonces, timeout):
+        self.max_customers = max_customers
+        self.max_nonces = max_nonces
+        self.timeout = timeout
+        self._customers = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, customer, nonce):
+        """
+        The errors cached for a nonce, or None if it's unknown or expired
+        """
+        with self._lock:
+            nonces = self._customers.get(customer)
+            if nonces is None or nonce not in nonces:
+                return None
+
+            expires, errors = nonces[nonce]
+            if expires <= time.time():
+                del nonces[nonce]
+                return None
+
+            self._customers.move_to_end(customer)
+            return errors
+
+    def set(self, customer, nonce, errors):
+        """
+        Cache the errors for a nonce, evicting the oldest entries if needed
+        """
+        with self._lock:
+            nonces = self._customers.pop(customer, None) or OrderedDict()
+            self._customers[customer] = nonces
+
+            nonces.pop(nonce, None)
+            nonces[nonce] = (time.time() + self.timeout, errors)
+
+            while len(nonces) > self.max_nonces:
+                nonces.popitem(last=False)
+            while len(self._customers) > self.max_customers:
+                self._customers.popitem(last=False)
@@ -34,6 +34,9 @@ class Card(db.Model):
     A Card keeps a balance and it's associated to a User
     """
 
+    # The Cards of a User are listed using keyset pagination over this index
+    __table_args__ = (db.Index('ix_card_user_id_id', 'user_id', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.Text, unique=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
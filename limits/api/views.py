@@ -1,21 +1,32 @@
 from datetime import datetime, timedelta
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
 
 import braintree
 import markdown
-from braintree import Transaction, TransactionSearch
+from braintree import ErrorCodes, Transaction, TransactionSearch
 from flask import (
     Blueprint, abort, current_app, jsonify, render_template, request, session
 )
 from sqlalchemy.orm import exc
-from werkzeug.exceptions import HTTPException
+from werkzeug.exceptions import HTTPException, NotFound
 
-from limits.api.models import User, db
+from limits.api.models import Card, User, db
 
 
 api = Blueprint('api', __name__, template_folder='templates',
                 static_folder='static')
 
+# The validation errors returned by Braintree when a nonce can't be used again
+NONCE_TERMINAL_ERROR_CODES = frozenset([
+    ErrorCodes.Transaction.PaymentMethodNonceConsumed,
+    ErrorCodes.Transaction.PaymentMethodNonceUnknown,
+    ErrorCodes.Transaction.PaymentMethodNonceLocked,
+])
+
+# The message returned by Braintree along with the 'PaymentMethodNonceConsumed'
+# error code, so that a nonce reused after a success gets the same error
+NONCE_CONSUMED_MESSAGE = 'Cannot use a payment_method_nonce more than once.'
+
 
 @api.errorhandler(HTTPException)
 @api.errorhandler(404)
@@ -47,19 +58,49 @@ def generate_token():
 
     ensure_customer_created(user)
 
-    client_token = braintree.ClientToken.generate({
+    client_token = get_gateway().ClientToken.generate({
         'customer_id': user.customer_id
     })
 
     return jsonify({'client_token': client_token})
 
 
+@api.route('/cards/', methods=['GET'])
+def list_cards():
+    """
+    This endpoint lists the Cards of the User, one page at a time
+    """
+    after, limit, with_headroom = parse_list_cards_input()
+
+    user = get_user()
+    cards = user.cards.filter(Card.id > after).order_by(Card.id)
+    cards = cards.limit(limit + 1).all()
+
+    next_after = cards[limit - 1].id if len(cards) > limit else None
+    cards = cards[:limit]
+
+    if with_headroom and cards:
+        window_headroom = calculate_window_headroom(user)
+    else:
+        window_headroom = None
+
+    return jsonify({
+        'cards': [serialize_card(card, window_headroom) for card in cards],
+        'next': next_after,
+    })
+
+
 @api.route('/cards/<card_id>/load/', methods=['POST'])
 def load_card(card_id):
     """
     This endpoint allows to load a Card with money
     """
     nonce, amount = parse_load_card_input()
+
+    errors = get_nonce_outcome(nonce)
+    if errors:
+        return jsonify({'status': 'error', 'errors': errors}), 400
+
     amount = Decimal(amount)
 
     user = get_user()
@@ -73,6 +114,7 @@ def load_card(card_id):
 
     result = make_transaction(user, amount, nonce)
     errors = check_transaction(result)
+    remember_nonce_outcome(nonce, result, errors)
 
     if not errors:
         card.balance += amount
@@ -83,6 +125,80 @@ def load_card(card_id):
     return jsonify({'status': status, 'errors': errors}), status_code
 
 
+@api.route('/loads/batch', methods=['POST'])
+def load_cards_batch():
+    """
+    This endpoint allows to load many Cards with money in a single request
+    """
+    items = parse_load_cards_batch_input()
+
+    user = get_user()
+    card_ids = {str(card_id) for card_id, _, _ in items}
+    cards = {str(card.id): card
+             for card in user.cards.filter(Card.id.in_(card_ids))}
+
+    ensure_customer_created(user)
+
+    # The history is searched once for the whole batch, every successful load
+    # is added to the totals so that the next items are checked against it.
+    window_totals = calculate_window_totals(get_customer_transactions(user))
+
+    results = []
+    for card_id, amount, nonce in items:
+        card = cards.get(str(card_id))
+        result = None
+
+        # A failure must not hide the results of the loads already charged
+        try:
+            errors = check_load_from_batch(card, amount, nonce, window_totals)
+            if not errors:
+                result = make_transaction(user, amount, nonce)
+                errors = check_transaction(result)
+                remember_nonce_outcome(nonce, result, errors)
+            if not errors:
+                card.balance += amount
+                db.session.commit()
+        except Exception as error:
+            current_app.logger.exception('Batch load failed: %s', card_id)
+            db.session.rollback()
+            errors = [serialize_error('http-500', type(error).__name__)]
+
+        charged = result is not None and result.is_success
+        if charged:
+            window_totals = [(limit, total_amount + amount)
+                             for limit, total_amount in window_totals]
+        if charged and errors:
+            errors = [serialize_error(
+                'charged-not-saved',
+                'The payment was charged but the Card balance was not '
+                'updated: {}'.format(errors[0]['message']))]
+
+        results.append({
+            'card_id': card_id,
+            'status': 'ok' if not errors else 'error',
+            'charged': charged,
+            'errors': errors,
+        })
+
+    failed = any(result['errors'] for result in results)
+    return jsonify({'status': 'error' if failed else 'ok', 'results': results})
+
+
+def check_load_from_batch(card, amount, nonce, window_totals):
+    """
+    Check that a load from a batch can be charged, given the amount already
+    loaded over every period of time
+    """
+    errors = get_nonce_outcome(nonce)
+    if errors:
+        return errors
+
+    if card is None:
+        return [serialize_error('http-404', NotFound.description)]
+
+    return check_limits_by_totals(window_totals, card, amount)
+
+
 @api.route('/index.html')
 @api.route('/')
 def home():
@@ -98,6 +214,17 @@ def home():
     return render_template('api/home.html', content=html)
 
 
+def get_compliance_limits():
+    """
+    The limits that apply to the loads of a Customer over a period of time
+    """
+    return (
+        (current_app.config['LIMIT_DAY'], timedelta(days=1)),
+        (current_app.config['LIMIT_MONTH'], timedelta(days=30)),
+        (current_app.config['LIMIT_YEAR'], timedelta(days=365)),
+    )
+
+
 def check_limits(user, card, amount):
     """
     We need to check that the load does not exceed some compliance limits:
@@ -107,18 +234,20 @@ def check_limits(user, card, amount):
         - maximum £2000 worth of loads per 365 days
         - maximum balance at any time £1000
     """
-    compliance_limits = (
-        (current_app.config['LIMIT_DAY'], timedelta(days=1)),
-        (current_app.config['LIMIT_MONTH'], timedelta(days=30)),
-        (current_app.config['LIMIT_YEAR'], timedelta(days=365)),
-    )
-
     transactions = get_customer_transactions(user)
 
+    return check_limits_by_totals(calculate_window_totals(transactions),
+                                  card, amount)
+
+
+def check_limits_by_totals(window_totals, card, amount):
+    """
+    Check the compliance limits of a load given the amount already loaded over
+    every period of time (see `calculate_window_totals`)
+    """
     errors = []
 
-    for limit, time_diff in compliance_limits:
-        total_amount = calculate_total_amount_by_date(transactions, time_diff)
+    for limit, total_amount in window_totals:
         if total_amount + amount > limit:
             time_diff_str = str(timedelta(days=1)).split(',')[0]
             errors.append(serialize_compliance_error(total_amount, amount,
@@ -132,6 +261,50 @@ def check_limits(user, card, amount):
     return errors
 
 
+def calculate_window_totals(transactions):
+    """
+    The amount loaded over every period of time with a compliance limit, as
+    a list of (limit, total amount) pairs
+    """
+    # The search results can only be iterated once
+    transactions = list(transactions)
+
+    return [
+        (limit, calculate_total_amount_by_date(transactions, time_diff))
+        for limit, time_diff in get_compliance_limits()
+    ]
+
+
+def calculate_window_headroom(user):
+    """
+    The amount that the User can still load before reaching any of the
+    compliance limits over a period of time.
+    All the periods are calculated from a single search of Transactions.
+    """
+    transactions = get_customer_transactions(user)
+
+    return min(
+        Decimal(limit) - total_amount
+        for limit, total_amount in calculate_window_totals(transactions)
+    )
+
+
+def serialize_card(card, window_headroom=None):
+    """
+    Produce a Card in the format specified by the API (see README)
+    """
+    serialized = {'id': card.id, 'name': card.name,
+                  'balance': str(card.balance)}
+
+    if window_headroom is not None:
+        balance_headroom = (Decimal(current_app.config['LIMIT_BALANCE']) -
+                            card.balance)
+        headroom = max(min(window_headroom, balance_headroom), Decimal(0))
+        serialized['headroom'] = str(headroom)
+
+    return serialized
+
+
 def serialize_compliance_error(total_amount, amount, limit, code):
     """
     Produce a Complacence error in the format specified by the API (see README)
@@ -159,12 +332,20 @@ def calculate_total_amount_by_date(transactions, time_diff):
     ), Decimal(0))
 
 
+def get_gateway():
+    """
+    The Braintree SDK, unless the application provides a replacement for it
+    (e.g. the stub used to replay traffic)
+    """
+    return current_app.extensions.get('braintree_gateway', braintree)
+
+
 def get_customer_transactions(user):
     """
     Fetch all the Transactions from a given User / Customer that have been
     Settled or could end up been Settled.
     """
-    return braintree.Transaction.search(
+    return get_gateway().Transaction.search(
         TransactionSearch.customer_id == user.customer_id,
         TransactionSearch.status.in_list([
             Transaction.Status.Authorizing,
@@ -203,7 +384,7 @@ def ensure_customer_created(user, *, nonce=None):
     if nonce is not None:
         payload['payment_method_nonce'] = nonce
 
-    braintree.Customer.create(payload)
+    get_gateway().Customer.create(payload)
 
 
 def parse_load_card_input():
@@ -221,11 +402,84 @@ def parse_load_card_input():
     return nonce, amount
 
 
+def parse_load_cards_batch_input():
+    """
+    Parse a batch of loads from a json body, as (card id, amount, nonce)
+    """
+    request_body = request.get_json(force=True)
+
+    try:
+        items = [(parse_batch_card_id(item['card_id']),
+                  parse_batch_amount(item['amount']),
+                  parse_batch_nonce(item['nonce']))
+                 for item in request_body['loads']]
+    except (KeyError, TypeError):
+        abort(400)
+
+    if not items or len(items) > current_app.config['LOADS_BATCH_SIZE_MAX']:
+        abort(400)
+
+    return items
+
+
+def parse_batch_card_id(card_id):
+    """
+    Parse the id of the Card of a load from a batch, it must be an integer or
+    a string
+    """
+    if isinstance(card_id, bool) or not isinstance(card_id, (int, str)):
+        abort(400)
+
+    return card_id
+
+
+def parse_batch_nonce(nonce):
+    """
+    Parse the nonce of a load from a batch, it must be a non empty string
+    """
+    if not isinstance(nonce, str) or not nonce:
+        abort(400)
+
+    return nonce
+
+
+def parse_batch_amount(amount):
+    """
+    Parse the amount of a load from a batch, it must be a string with a
+    positive number
+    """
+    if not isinstance(amount, str):
+        abort(400)
+
+    try:
+        amount = Decimal(amount)
+    except InvalidOperation:
+        abort(400)
+
+    if not amount.is_finite() or amount <= 0:
+        abort(400)
+
+    return amount
+
+
+def parse_list_cards_input():
+    """
+    Parse the pagination parameters from the query string
+    """
+    after = request.args.get('after', 0, type=int)
+    limit = request.args.get('limit', current_app.config['CARDS_PAGE_SIZE'],
+                             type=int)
+    limit = min(max(limit, 1), current_app.config['CARDS_PAGE_SIZE_MAX'])
+    with_headroom = request.args.get('headroom', '').lower() in ('1', 'true')
+
+    return after, limit, with_headroom
+
+
 def make_transaction(user, amount, nonce):
     """
     Execure a Transaction on Braintree
     """
-    return braintree.Transaction.sale({
+    return get_gateway().Transaction.sale({
         'amount': amount,
         'payment_method_nonce': nonce,
         'customer_id': user.customer_id,
@@ -235,6 +489,38 @@ def make_transaction(user, amount, nonce):
     })
 
 
+def get_nonce_outcome(nonce):
+    """
+    Retrieve the errors cached for a nonce of the User in the session, if the
+    nonce has already been consumed or declined
+    """
+    nonce_cache = current_app.extensions['nonce_cache']
+    return nonce_cache.get(session['user'], nonce)
+
+
+def remember_nonce_outcome(nonce, result, errors):
+    """
+    Cache the outcome of a Transaction if its nonce can't be used again: it
+    was charged, declined by the processor, or Braintree reported that the
+    nonce is consumed, unknown or locked.
+    Other errors are not cached, the same nonce could still be used.
+    """
+    if result.is_success:
+        errors = [serialize_error(
+            ErrorCodes.Transaction.PaymentMethodNonceConsumed,
+            NONCE_CONSUMED_MESSAGE)]
+    elif result.errors.deep_errors:
+        codes = {error.code for error in result.errors.deep_errors}
+        if not codes & NONCE_TERMINAL_ERROR_CODES:
+            return
+    elif not (result.transaction.processor_settlement_response_code or
+              result.transaction.processor_response_code):
+        return
+
+    nonce_cache = current_app.extensions['nonce_cache']
+    nonce_cache.set(session['user'], nonce, errors)
+
+
 def check_transaction(result):
     """
     The transaction may have been successful or it may have returned different
@@ -0,0 +1,278 @@
+import csv
+import math
+from collections import namedtuple
+from datetime import timedelta
+
+import numpy
+
+
+# The history of loads, one NumPy array per column, sorted by customer and
+# date. Amounts are stored in pennies so that the sums are exact, like the
+# Decimal sums of the API, and dates in milliseconds.
+History = namedtuple('History', ['customer', 'card', 'created_at', 'amount'])
+
+LimitSet = namedtuple('LimitSet', ['day', 'month', 'year', 'balance'])
+
+BacktestResult = namedtuple('BacktestResult', [
+    'limits', 'loads', 'rejected', 'day', 'month', 'year', 'balance',
+])
+
+
+# The Customer ids are 36 characters maximum (see `User`) and the Card ids are
+# integers. Fixed size bytes take much less memory than Python strings.
+HISTORY_CSV_DTYPE = [
+    ('customer_id', 'S36'),
+    ('card_id', numpy.int64),
+    ('created_at', numpy.float64),
+    ('amount', numpy.float64),
+]
+
+
+WINDOWS = (
+    ('day', timedelta(days=1)),
+    ('month', timedelta(days=30)),
+    ('year', timedelta(days=365)),
+)
+
+
+def load_history(path):
+    """
+    Load an exported history of loads into columnar arrays.
+
+    Both '.npz' archives and CSV files are accepted, with the columns:
+    'customer_id', 'card_id', 'created_at' (a Unix timestamp in seconds,
+    rounded to the millisecond) and 'amount'. CSV files are parsed straight
+    into typed arrays, but '.npz' archives are much faster to load for large
+    histories, specially if their ids are already encoded as integers from 0
+    to the number of loads.
+    """
+    if path.endswith('.npz'):
+        with numpy.load(path) as archive:
+            columns = {name: archive[name] for name in archive.files}
+    else:
+        with open(path, newline='') as history_file:
+            header = next(csv.reader(history_file))
+        columns = numpy.loadtxt(
+            path, dtype=HISTORY_CSV_DTYPE, delimiter=',', skiprows=1,
+            comments=None, ndmin=1,
+            usecols=[header.index(name) for name, _ in HISTORY_CSV_DTYPE])
+
+    return build_history(columns['customer_id'], columns['card_id'],
+                         columns['created_at'], columns['amount'])
+
+
+def build_history(customer_ids, card_ids, created_at, amounts):
+    """
+    Encode the raw columns and sort them by customer and date
+    """
+    created_at = numpy.asarray(created_at).astype(numpy.float64)
+    amount = numpy.asarray(amounts).astype(numpy.float64)
+
+    history = History(
+        customer=encode_ids(customer_ids),
+        card=encode_ids(card_ids),
+        created_at=numpy.rint(created_at * 1000).astype(numpy.int64),
+        amount=numpy.rint(amount * 100).astype(numpy.int64),
+    )
+
+    order = numpy.argsort(group_by_date_key(history.customer,
+                                            history.created_at),
+                          kind='mergesort')
+    return History(*(column[order] for column in history))
+
+
+def encode_ids(ids):
+    """
+    Encode a column of ids as small integers, so that they can be part of a
+    `group_by_date_key`.
+
+    Integer ids that are already small are used as they are. Other ids are
+    grouped by a 64 bits hash, which is much faster to sort than the ids.
+    """
+    ids = numpy.asarray(ids)
+    is_integer = ids.dtype.kind in 'iu'
+
+    if not len(ids):
+        return numpy.zeros(0, dtype=numpy.int64)
+    if is_integer and ids.min() >= 0 and ids.max() < len(ids):
+        return ids.astype(numpy.int64)
+
+    hashes = ids.astype(numpy.int64) if is_integer else hash_ids(ids)
+    if hashes is None:
+        return numpy.unique(ids, return_inverse=True)[1].astype(numpy.int64)
+
+    order = numpy.argsort(hashes)
+    sorted_hashes = hashes[order]
+    first = numpy.concatenate(
+        ([True], sorted_hashes[1:] != sorted_hashes[:-1]))
+
+    codes = numpy.empty(len(ids), dtype=numpy.int64)
+    codes[order] = numpy.cumsum(first) - 1
+
+    # Two different ids with the same hash would be merged, compare the ids
+    # with the first one of their group to fall back to a full sort then.
+    if not is_integer and not numpy.array_equal(ids[order[first]][codes], ids):
+        codes = numpy.unique(ids, return_inverse=True)[1].astype(numpy.int64)
+
+    return codes
+
+
+def hash_ids(ids):
+    """
+    A 64 bits hash of every string of a column, or None if the column doesn't
+    contain fixed size strings
+    """
+    if ids.dtype.kind not in 'SU':
+        return None
+
+    # Pad the strings so that they can be read as 64 bits words
+    char_size = 1 if ids.dtype.kind == 'S' else 4
+    width = -(-ids.dtype.itemsize // 8) * 8
+    words = ids.astype('{}{}'.format(ids.dtype.kind, width // char_size))
+    words = words.view(numpy.uint64).reshape(len(ids), -1)
+
+    hashes = numpy.full(len(ids), 0xcbf29ce484222325, dtype=numpy.uint64)
+    with numpy.errstate(over='ignore'):
+        for column in range(words.shape[1]):
+            hashes ^= words[:, column]
+            hashes *= numpy.uint64(0x100000001b3)
+            hashes ^= hashes >> numpy.uint64(29)
+
+    return hashes
+
+
+def group_by_date_key(groups, created_at):
+    """
+    A single integer key that sorts by group and then by date, which is much
+    faster to sort and to search than a pair of columns. It must be sorted
+    with a stable algorithm, so that the loads with the same date keep their
+    order.
+    """
+    if not len(created_at):
+        return groups.copy()
+
+    offset = created_at - created_at.min()
+    span = int(offset.max()) + 1
+    if (int(groups.max()) + 1) * span > numpy.iinfo(numpy.int64).max:
+        raise ValueError('The history is too long to be backtested at once')
+
+    return groups * span + offset
+
+
+def calculate_window_totals(history):
+    """
+    For every load, the amount loaded by the same customer during each window
+    before it, the same sums that `check_limits` compares with the limits.
+    """
+    # The history is sorted by this key, so the start of every window can be
+    # found with a binary search. The windows can't go further back than the
+    # first load of the customer.
+    key = group_by_date_key(history.customer, history.created_at)
+    first = group_starts(history.customer)
+    cumulative = numpy.concatenate(([0], numpy.cumsum(history.amount)))
+    before = cumulative[:-1]
+
+    totals = {}
+    for name, time_diff in WINDOWS:
+        milliseconds = int(time_diff.total_seconds() * 1000)
+        start = numpy.searchsorted(key, key - milliseconds, side='left')
+        totals[name] = before - cumulative[numpy.maximum(start, first)]
+
+    return totals
+
+
+def calculate_balances(history):
+    """
+    For every load, the balance of the card right before it
+    """
+    order = numpy.argsort(group_by_date_key(history.card, history.created_at),
+                          kind='mergesort')
+    card = history.card[order]
+    amount = history.amount[order]
+
+    cumulative = numpy.cumsum(amount) - amount
+    balances = cumulative - cumulative[group_starts(card)]
+
+    result = numpy.empty_like(balances)
+    result[order] = balances
+    return result
+
+
+def group_starts(groups):
+    """
+    For every position of a sorted array, the position where its group starts
+    """
+    starts = numpy.zeros(len(groups), dtype=numpy.int64)
+    if len(groups):
+        changes = numpy.flatnonzero(groups[1:] != groups[:-1]) + 1
+        starts[changes] = changes
+        numpy.maximum.accumulate(starts, out=starts)
+    return starts
+
+
+def backtest(history, limit_sets):
+    """
+    Count how many loads of the history would have been rejected with each
+    set of limits.
+
+    Every load is checked against the history as it happened, i.e. loads that
+    would have been rejected still count towards the following windows.
+    """
+    totals = calculate_window_totals(history)
+    balances = calculate_balances(history)
+
+    results = []
+    for limits in limit_sets:
+        rejected = {
+            name: totals[name] + history.amount > to_pennies(
+                getattr(limits, name))
+            for name, _ in WINDOWS
+        }
+        rejected['balance'] = balances + history.amount > to_pennies(
+            limits.balance)
+
+        any_rejected = numpy.zeros(len(history.amount), dtype=bool)
+        for mask in rejected.values():
+            any_rejected |= mask
+
+        results.append(BacktestResult(
+            limits=limits,
+            loads=len(history.amount),
+            rejected=int(any_rejected.sum()),
+            **{name: int(mask.sum()) for name, mask in rejected.items()}
+        ))
+
+    return results
+
+
+def to_pennies(amount):
+    """
+    Convert an amount of money into pennies
+    """
+    return int(round(float(amount) * 100))
+
+
+def parse_limit_set(value):
+    """
+    Parse a set of limits from a 'DAY,MONTH,YEAR,BALANCE' string
+    """
+    values = value.split(',')
+    if len(values) != len(LimitSet._fields):
+        raise ValueError('Expected DAY,MONTH,YEAR,BALANCE: {}'.format(value))
+
+    limits = LimitSet(*(float(limit) for limit in values))
+    if not all(math.isfinite(limit) for limit in limits):
+        raise ValueError('The limits must be finite numbers: {}'.format(value))
+
+    return limits
+
+
+def format_result(result):
+    """
+    Produce a human readable summary of a backtest
+    """
+    limits = ','.join('{:g}'.format(limit) for limit in result.limits)
+    return '{}: {} of {} loads rejected ({})'.format(
+        limits, result.rejected, result.loads, ', '.join(
+            '{} {}'.format(name, getattr(result, name))
+            for name in LimitSet._fields))
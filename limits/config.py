@@ -20,6 +20,24 @@ class BaseConfig(object):
     LIMIT_YEAR = 2000
     LIMIT_BALANCE = 1000
 
+    # Default and maximum number of Cards returned per page by `/cards/`
+    CARDS_PAGE_SIZE = 100
+    CARDS_PAGE_SIZE_MAX = 1000
+
+    # Maximum number of loads accepted by `/loads/batch`
+    LOADS_BATCH_SIZE_MAX = 500
+
+    # The errors of the nonces that have been consumed or declined are cached,
+    # so that a client resending them gets a fast answer (timeout in seconds)
+    NONCE_CACHE_MAX_CUSTOMERS = 10000
+    NONCE_CACHE_MAX_NONCES = 100
+    NONCE_CACHE_TIMEOUT = 24 * 60 * 60
+
+    # Append the shape and timing of the requests that reach Braintree to
+    # this file as JSON lines, so that they can be replayed later with
+    # `flask replay`. Disabled by default.
+    RECORDER_PATH = None
+
 
 class BraintreeSandBoxMixin(object):
 
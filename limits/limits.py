@@ -1,9 +1,18 @@
+import os
+import tempfile
+
 import braintree
+import click
 from flask import Flask, session
 
 from limits.api import api
+from limits.api.cache import NonceCache
 from limits.api.models import User, db, init_db, populate_db_with_fake_state
 from limits.config import PROJECT_NAME
+from limits.replay import (
+    ReplayConfig, configure_recorder, configure_scratch_app, format_report,
+    read_records, replay_records
+)
 
 
 def create_app(config):
@@ -17,9 +26,16 @@ def create_app(config):
 
     db.init_app(app)
 
+    app.extensions['nonce_cache'] = NonceCache(
+        max_customers=app.config['NONCE_CACHE_MAX_CUSTOMERS'],
+        max_nonces=app.config['NONCE_CACHE_MAX_NONCES'],
+        timeout=app.config['NONCE_CACHE_TIMEOUT'],
+    )
+
     app.register_blueprint(api)
 
     configure_hooks(app)
+    configure_recorder(app)
     configure_cli(app)
 
     return app
@@ -40,6 +56,64 @@ def configure_cli(app):
         populate_db_with_fake_state()
         app.logger.info('Done')
 
+    @app.cli.command('replay')
+    @click.argument('records', type=click.File('r'))
+    @click.option('--speed', default=1.0, callback=validate_speed_option,
+                  help='Replay speed factor, 0 means as fast as possible')
+    @click.option('--workers', default=1, type=click.IntRange(min=1),
+                  help='Number of requests that can be sent concurrently')
+    def replay_command(records, speed, workers):
+        with tempfile.TemporaryDirectory() as directory:
+            scratch_app = create_app(ReplayConfig(app.config))
+            configure_scratch_app(app, scratch_app,
+                                  os.path.join(directory, 'replay.db'))
+
+            report = replay_records(scratch_app, read_records(records),
+                                    speed=speed, workers=workers)
+
+        click.echo(format_report(report))
+
+    @app.cli.command('backtest')
+    @click.argument('history', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--limits', 'limit_sets', multiple=True,
+                  callback=parse_limit_sets_option,
+                  help='Candidate limits as DAY,MONTH,YEAR,BALANCE')
+    def backtest_command(history, limit_sets):
+        # NumPy is only needed by this command, not by the application
+        from limits.backtest import (
+            LimitSet, backtest, format_result, load_history
+        )
+
+        if not limit_sets:
+            limit_sets = [LimitSet(
+                app.config['LIMIT_DAY'], app.config['LIMIT_MONTH'],
+                app.config['LIMIT_YEAR'], app.config['LIMIT_BALANCE'],
+            )]
+
+        for result in backtest(load_history(history), limit_sets):
+            click.echo(format_result(result))
+
+
+def validate_speed_option(context, parameter, value):
+    """
+    Validate the replay speed given on the command line
+    """
+    if value < 0:
+        raise click.BadParameter('The speed can not be negative')
+    return value
+
+
+def parse_limit_sets_option(context, parameter, values):
+    """
+    Validate the candidate limits given on the command line
+    """
+    from limits.backtest import parse_limit_set
+
+    try:
+        return [parse_limit_set(value) for value in values]
+    except ValueError as error:
+        raise click.BadParameter(str(error))
+
 
 def configure_hooks(app):
     """
@@ -0,0 +1,250 @@
+import json
+import math
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import g, request
+
+from limits.api.models import db, init_db
+
+
+# Only the endpoints that talk to Braintree are worth recording: they are the
+# ones that dominate the latency and the capacity of the service.
+RECORDED_ENDPOINTS = ('api.generate_token', 'api.load_card',
+                      'api.load_cards_batch')
+
+
+ReplayReport = namedtuple('ReplayReport', [
+    'requests', 'statuses', 'errors', 'elapsed', 'throughput',
+    'p50', 'p95', 'p99',
+])
+
+
+def configure_recorder(app):
+    """
+    Setup some hooks to record the traffic as JSON lines.
+    The recorder is disabled unless 'RECORDER_PATH' is configured.
+    """
+
+    @app.before_request
+    def start_recording():
+        if not app.config.get('RECORDER_PATH'):
+            return
+        if request.endpoint not in RECORDED_ENDPOINTS:
+            return
+
+        # Buffer the body now, so that it's still available after the view
+        # has parsed it as a form or as json.
+        request.get_data()
+        g.recorder_start = time.time()
+
+    @app.after_request
+    def stop_recording(response):
+        path = app.config.get('RECORDER_PATH')
+        start = g.pop('recorder_start', None)
+        if path and start is not None:
+            record = serialize_record(start, time.time() - start, response)
+            with open(path, 'a') as record_file:
+                record_file.write(json.dumps(record) + '\n')
+
+        return response
+
+
+def serialize_record(start, duration, response):
+    """
+    Produce a record with the shape and the timing of the current request
+    """
+    return {
+        'timestamp': start,
+        'duration': duration,
+        'method': request.method,
+        'path': request.path,
+        'content_type': request.content_type,
+        'data': request.get_data(as_text=True),
+        'status': response.status_code,
+    }
+
+
+def read_records(lines):
+    """
+    Parse a collection of JSON lines, sorted by their original timestamp
+    """
+    records = [json.loads(line) for line in lines if line.strip()]
+    return sorted(records, key=lambda record: record['timestamp'])
+
+
+def replay_records(app, records, *, speed=1.0, workers=1):
+    """
+    Replay a collection of records against the application.
+
+    The original pace is kept when 'speed' is 1, multiplied when it's bigger,
+    and ignored (as fast as possible) when it's 0. Every request is sent at
+    its due time to a pool of 'workers', so that overlapping requests are
+    replayed concurrently. The latencies are measured from the time when every
+    request was due, so that the time spent waiting for a free worker is not
+    left out when the application can't keep up with the pace.
+    """
+    latencies = []
+    statuses = Counter()
+
+    started = time.time()
+    first = records[0]['timestamp'] if records else 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for record in records:
+            if speed:
+                due = started + (record['timestamp'] - first) / speed
+                time.sleep(max(due - time.time(), 0))
+            else:
+                due = time.time()
+
+            futures.append(executor.submit(send_record, app, record, due))
+
+        for future in futures:
+            latency, status = future.result()
+            latencies.append(latency)
+            statuses[status] += 1
+
+    elapsed = time.time() - started
+
+    return build_report(latencies, statuses, elapsed)
+
+
+def send_record(app, record, due):
+    """
+    Send a recorded request to the application, return its latency (measured
+    from its due time) and its status code
+    """
+    response = app.test_client().open(
+        record['path'], method=record['method'],
+        content_type=record['content_type'], data=record['data'])
+
+    return time.time() - due, response.status_code
+
+
+def configure_scratch_app(source_app, scratch_app, database_path):
+    """
+    Setup an application to replay the traffic of another one:
+        - Use a copy of all the rows of the source database, so that a
+          replay never changes the original database
+        - Replace the Braintree SDK with a stub
+        - Disable the recorder
+    """
+    scratch_app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(
+        database_path)
+    scratch_app.config['RECORDER_PATH'] = None
+    scratch_app.extensions['braintree_gateway'] = StubGateway()
+
+    # Every application context removes the session when it ends, so that
+    # the session of each database is never reused for the other one.
+    with source_app.app_context():
+        rows = [(table, db.session.execute(table.select()).fetchall())
+                for table in db.metadata.sorted_tables]
+
+    with scratch_app.app_context():
+        init_db()
+        for table, table_rows in rows:
+            if table_rows:
+                db.session.execute(table.insert(),
+                                   [dict(row) for row in table_rows])
+        db.session.commit()
+
+
+class ReplayConfig(object):
+    """
+    A copy of the configuration of an application, used to create a scratch
+    application to replay the traffic
+    """
+
+    def __init__(self, config):
+        for key, value in config.items():
+            if key.isupper():
+                setattr(self, key, value)
+
+
+def build_report(latencies, statuses, elapsed):
+    """
+    Summarize the latencies (in seconds) and the status codes of a replay
+    """
+    latencies = sorted(latencies)
+    return ReplayReport(
+        requests=len(latencies),
+        statuses=statuses,
+        errors=sum(count for status, count in statuses.items()
+                   if not 200 <= status < 300),
+        elapsed=elapsed,
+        throughput=len(latencies) / elapsed if elapsed else 0.0,
+        p50=percentile(latencies, 50),
+        p95=percentile(latencies, 95),
+        p99=percentile(latencies, 99),
+    )
+
+
+def percentile(values, rank):
+    """
+    Nearest-rank percentile of a sorted collection of values
+    """
+    if not values:
+        return 0.0
+    index = max(math.ceil(len(values) * rank / 100) - 1, 0)
+    return values[index]
+
+
+def format_report(report):
+    """
+    Produce a human readable summary of a replay
+    """
+    return '\n'.join([
+        'Requests: {} ({} errors)'.format(report.requests, report.errors),
+    ] + [
+        'Status {}: {}'.format(status, count)
+        for status, count in sorted(report.statuses.items())
+    ] + [
+        'Elapsed: {:.3f}s'.format(report.elapsed),
+        'Throughput: {:.1f} req/s'.format(report.throughput),
+        'Latency p50: {:.1f}ms'.format(report.p50 * 1000),
+        'Latency p95: {:.1f}ms'.format(report.p95 * 1000),
+        'Latency p99: {:.1f}ms'.format(report.p99 * 1000),
+    ])
+
+
+class StubGateway(object):
+    """
+    Replace the parts of the Braintree SDK used by the API, so that a replay
+    never reaches the Sandbox: every payment succeeds and no Customer has any
+    previous Transaction.
+    """
+
+    class ClientToken(object):
+
+        @staticmethod
+        def generate(params):
+            return 'stub-client-token'
+
+    class Customer(object):
+
+        @staticmethod
+        def create(params):
+            return StubResult()
+
+    class Transaction(object):
+
+        @staticmethod
+        def search(*query):
+            return StubSearchResult()
+
+        @staticmethod
+        def sale(params):
+            return StubResult()
+
+
+class StubResult(object):
+
+    is_success = True
+
+
+class StubSearchResult(object):
+
+    items = ()
@@ -113,3 +113,20 @@ def test_load_exceed_limits(client):
         {'code': 'compliance-1 day', 'message':
          'ComplianceError: 0 + {} > 5000 (1 day)'.format(amount)},
     ]}
+
+
+def test_list_cards(client):
+    """
+    The client can list the cards with their balances and headroom
+    """
+    card = Card.query.one()
+    url = url_for('api.list_cards', headroom='true')
+
+    response = client.get(url)
+
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['next'] is None
+    assert [card_data['id'] for card_data in data['cards']] == [card.id]
+    assert set(data['cards'][0].keys()) == {'id', 'name', 'balance',
+                                            'headroom'}
@@ -1,15 +1,22 @@
 import os
+import time
+from datetime import datetime, timedelta
 from decimal import Decimal
 from unittest.mock import MagicMock, call, patch
 
+import numpy
 import pytest
-from flask import json
+from braintree import ErrorCodes
+from flask import json, url_for
 from werkzeug.exceptions import BadRequest, NotFound
 
-from limits.api.models import User
+from limits.api.cache import NonceCache
+from limits.api.models import Card, User, db
 from limits.api.views import (
     check_limits, get_card_or_404, handler_unknown_error
 )
+from limits.backtest import LimitSet, backtest, build_history, encode_ids
+from limits.replay import StubGateway, percentile, read_records, replay_records
 
 
 def test_setup(app, database, client):
@@ -113,3 +120,565 @@ def test_check_limits_balance(app, client):
         {'code': 'compliance-balance',
          'message': 'ComplianceError: 0 + 1 > 10000 (balance)'}
     ]
+
+
+def test_recorder(app, client, tmpdir):
+    """
+    The requests that reach Braintree are recorded as JSON lines
+    """
+    records_path = tmpdir.join('records.jsonl')
+    app.config['RECORDER_PATH'] = str(records_path)
+    card_id = Card.query.one().id
+    url = url_for('api.load_card', card_id=card_id)
+
+    app.extensions['braintree_gateway'] = StubGateway()
+    client.post(url, data={'nonce': 'fake-nonce', 'amount': '10.00'})
+    client.get(url_for('api.home'))
+
+    records = read_records(records_path.readlines())
+    assert len(records) == 1
+    assert records[0]['path'] == url
+    assert records[0]['status'] == 200
+    assert 'fake-nonce' in records[0]['data']
+
+
+@patch.dict(os.environ, {'FLASK_APP': 'limits'})
+@patch('click.core.Context.exit', MagicMock())
+def test_replay_command(app, client, tmpdir):
+    """
+    We can replay some recorded traffic and get a latency report, without
+    changing the database
+    """
+    card_id = Card.query.one().id
+    record = {
+        'timestamp': 0, 'duration': 0.1, 'method': 'POST',
+        'path': url_for('api.load_card', card_id=card_id),
+        'content_type': 'application/json',
+        'data': json.dumps({'nonce': 'fake-nonce', 'amount': '1.00'}),
+        'status': 200,
+    }
+    records_path = tmpdir.join('records.jsonl')
+    records_path.write(json.dumps(record) + '\n')
+    replay_command = app.cli.commands['replay']
+
+    with patch('limits.limits.click.echo') as echo_mock:
+        replay_command(args=(str(records_path), '--speed', '0'))
+
+    report = echo_mock.call_args[0][0]
+    assert 'Requests: 1 (0 errors)' in report
+    assert 'Status 200: 1' in report
+    assert Card.query.one().balance == Decimal(0)
+
+
+def slow_client(delay):
+    """
+    A test client that takes some time to answer every request
+    """
+    def slow_open(*args, **kwargs):
+        time.sleep(delay)
+        return MagicMock(status_code=200)
+
+    return MagicMock(open=MagicMock(side_effect=slow_open))
+
+
+def test_replay_latency_from_due_time(app):
+    """
+    The latencies include the time that a request waits for a free worker
+    when the application can't keep up with the recorded pace
+    """
+    records = [
+        {'timestamp': 0, 'method': 'GET', 'path': '/', 'content_type': None,
+         'data': ''}
+    ] * 3
+
+    with patch.object(app, 'test_client', return_value=slow_client(0.1)):
+        report = replay_records(app, records, speed=1, workers=1)
+
+    assert report.p50 >= 0.2
+    assert report.p99 >= 0.3
+    assert report.statuses == {200: 3}
+
+
+def test_replay_workers(app):
+    """
+    Overlapping requests are replayed concurrently by a pool of workers
+    """
+    records = [
+        {'timestamp': 0, 'method': 'GET', 'path': '/', 'content_type': None,
+         'data': ''}
+    ] * 3
+
+    with patch.object(app, 'test_client', return_value=slow_client(0.1)):
+        report = replay_records(app, records, speed=1, workers=3)
+
+    assert report.p99 < 0.2
+    assert report.elapsed < 0.2
+
+
+@patch.dict(os.environ, {'FLASK_APP': 'limits'})
+@patch('click.core.Context.exit', MagicMock())
+def test_replay_command_negative_speed(app, tmpdir):
+    """
+    The replay speed can not be negative
+    """
+    records_path = tmpdir.join('records.jsonl')
+    records_path.write('')
+    replay_command = app.cli.commands['replay']
+
+    with patch('limits.limits.replay_records') as replay_records_mock:
+        with pytest.raises(SystemExit):
+            replay_command(args=(str(records_path), '--speed', '-1'))
+
+    assert replay_records_mock.call_count == 0
+
+
+def test_percentile():
+    """
+    Percentiles are calculated using the nearest-rank method
+    """
+    values = list(range(1, 101))
+
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 99) == 99
+    assert percentile([], 99) == 0.0
+
+
+def test_list_cards_pagination(app, client):
+    """
+    The Cards are listed in pages, each page points to the next one
+    """
+    user = User.query.one()
+    db.session.add_all(Card(user, 'Card-{}'.format(i)) for i in range(2, 6))
+    db.session.commit()
+    card_ids = [card.id for card in Card.query.order_by(Card.id)]
+
+    pages = []
+    url = url_for('api.list_cards', limit=2)
+    while url:
+        data = json.loads(client.get(url).data)
+        pages.append([card['id'] for card in data['cards']])
+        url = data['next'] and url_for('api.list_cards', limit=2,
+                                       after=data['next'])
+
+    assert pages == [card_ids[:2], card_ids[2:4], card_ids[4:]]
+
+
+def test_list_cards_headroom(app, client):
+    """
+    The headroom of every Card is calculated from a single search
+    """
+    user = User.query.one()
+    card = Card(user, 'Card-2')
+    card.balance = Decimal(app.config['LIMIT_BALANCE'] - 1)
+    db.session.add(card)
+    db.session.commit()
+    url = url_for('api.list_cards', headroom='1')
+
+    with patch('limits.api.views.braintree') as braintree_mock:
+        braintree_mock.Transaction.search.return_value.items = []
+        data = json.loads(client.get(url).data)
+
+    assert braintree_mock.Transaction.search.call_count == 1
+    assert [Decimal(card['headroom']) for card in data['cards']] == [
+        Decimal(app.config['LIMIT_DAY']), Decimal(1),
+    ]
+
+
+def test_backtest():
+    """
+    Every load of the history is checked against the loads before it
+    """
+    history = build_history(
+        customer_ids=['a', 'a', 'a', 'b', 'b'],
+        card_ids=['a-1', 'a-2', 'a-1', 'b-1', 'b-1'],
+        created_at=[0, 10, 90000, 5, 60],
+        amounts=['400.00', '100.01', '50.00', '900.00', '200.00'],
+    )
+
+    result, = backtest(history, [LimitSet(500, 800, 2000, 1000)])
+
+    assert result.loads == 5
+    assert result.rejected == 3
+    assert (result.day, result.month, result.year, result.balance) == (
+        3, 2, 0, 1)
+
+
+def test_backtest_window_edges():
+    """
+    The windows are calculated with the same precision than `check_limits`
+    """
+    limit_sets = [LimitSet(500, 800, 2000, 1000)]
+    outside = build_history(['a', 'a'], [1, 1], [0.3, 86400.5],
+                            ['400.00', '200.00'])
+    inside = build_history(['a', 'a'], [1, 1], [0.5, 86400.5],
+                           ['400.00', '200.00'])
+
+    assert backtest(outside, limit_sets)[0].day == 0
+    assert backtest(inside, limit_sets)[0].day == 1
+
+
+def test_encode_ids():
+    """
+    The ids are encoded as small integers, equal ids get the same integer
+    """
+    customer_ids = numpy.array([b'b', b'a', b'b', b'c'], dtype='S36')
+    card_ids = numpy.array([10 ** 12, 7, 7, 10 ** 12])
+
+    customers = encode_ids(customer_ids)
+    cards = encode_ids(card_ids)
+
+    assert customers[0] == customers[2]
+    assert len(set(customers)) == 3
+    assert cards[0] == cards[3] and cards[1] == cards[2]
+    assert set(cards) <= set(range(len(card_ids)))
+    assert list(encode_ids(numpy.array([2, 0, 1]))) == [2, 0, 1]
+
+
+@patch.dict(os.environ, {'FLASK_APP': 'limits'})
+def test_backtest_command_invalid_limits(app, tmpdir):
+    """
+    The candidate limits must be finite numbers
+    """
+    history_path = tmpdir.join('history.csv')
+    history_path.write('customer_id,card_id,created_at,amount\n')
+    backtest_command = app.cli.commands['backtest']
+
+    with patch('limits.backtest.backtest') as backtest_mock:
+        with pytest.raises(SystemExit):
+            backtest_command(args=(str(history_path), '--limits',
+                                   'nan,800,2000,1000'))
+
+    assert backtest_mock.call_count == 0
+
+
+@patch.dict(os.environ, {'FLASK_APP': 'limits'})
+@patch('click.core.Context.exit', MagicMock())
+def test_backtest_command(app, tmpdir):
+    """
+    We can backtest some candidate limits with an exported history
+    """
+    history_path = tmpdir.join('history.csv')
+    history_path.write('customer_id,card_id,created_at,amount\n'
+                       'a,1,0,400.00\n'
+                       'a,1,10,200.00\n')
+    backtest_command = app.cli.commands['backtest']
+
+    with patch('limits.limits.click.echo') as echo_mock:
+        backtest_command(args=(str(history_path), '--limits',
+                               '500,800,2000,1000'))
+
+    assert echo_mock.call_args_list == [call(
+        '500,800,2000,1000: 1 of 2 loads rejected '
+        '(day 1, month 0, year 0, balance 0)'
+    )]
+
+
+def test_list_cards_headroom_history(app, client):
+    """
+    The headroom of a Card includes the loads of every period of time
+    """
+    transaction = MagicMock(amount=Decimal(4000),
+                            created_at=datetime.now() - timedelta(days=10))
+    url = url_for('api.list_cards', headroom='1')
+
+    with patch('limits.api.views.braintree') as braintree_mock:
+        braintree_mock.Transaction.search.return_value.items = iter(
+            [transaction])
+        data = json.loads(client.get(url).data)
+
+    assert Decimal(data['cards'][0]['headroom']) == Decimal(
+        app.config['LIMIT_MONTH'] - 4000)
+
+
+def test_load_cards_batch(app, client):
+    """
+    The compliance limits of a batch are checked cumulatively, searching the
+    history of Transactions only once
+    """
+    card = Card.query.one()
+    transaction = MagicMock(amount=Decimal(3500),
+                            created_at=datetime.now() - timedelta(days=10))
+    loads = [
+        {'card_id': card.id, 'amount': '3000.00', 'nonce': 'fake-nonce-1'},
+        {'card_id': card.id, 'amount': '2500.00', 'nonce': 'fake-nonce-2'},
+        {'card_id': 42, 'amount': '1.00', 'nonce': 'fake-nonce-3'},
+        {'card_id': card.id, 'amount': '1000.00', 'nonce': 'fake-nonce-4'},
+        {'card_id': card.id, 'amount': '1000.00', 'nonce': 'fake-nonce-5'},
+    ]
+    url = url_for('api.load_cards_batch')
+
+    with patch('limits.api.views.braintree') as braintree_mock:
+        braintree_mock.Transaction.search.return_value.items = iter(
+            [transaction])
+        response = client.post(url, content_type='application/json',
+                               data=json.dumps({'loads': loads}))
+
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['status'] == 'error'
+    assert [result['status'] for result in data['results']] == [
+        'ok', 'error', 'error', 'ok', 'error']
+    assert data['results'][1]['errors'][0]['code'] == 'compliance-1 day'
+    assert data['results'][2]['errors'][0]['code'] == 'http-404'
+    assert [result['card_id'] for result in data['results']] == [
+        card.id, card.id, 42, card.id, card.id]
+    assert data['results'][4]['errors'] == [
+        {'code': 'compliance-1 day',
+         'message': 'ComplianceError: 7500.00 + 1000.00 > 8000 (1 day)'},
+    ]
+    assert braintree_mock.Transaction.search.call_count == 1
+    assert braintree_mock.Customer.create.call_count == 1
+    assert braintree_mock.Transaction.sale.call_count == 2
+    assert Card.query.one().balance == Decimal('4000.00')
+
+
+def test_load_cards_batch_failure(app, client):
+    """
+    If a load of a batch fails, the results of the other loads are returned
+    """
+    card = Card.query.one()
+    loads = [
+        {'card_id': card.id, 'amount': '10.00', 'nonce': 'fake-nonce-1'},
+        {'card_id': card.id, 'amount': '20.00', 'nonce': 'fake-nonce-2'},
+        {'card_id': card.id, 'amount': '30.00', 'nonce': 'fake-nonce-3'},
+    ]
+    url = url_for('api.load_cards_batch')
+
+    with patch('limits.api.views.braintree') as braintree_mock:
+        braintree_mock.Transaction.search.return_value.items = iter([])
+        braintree_mock.Transaction.sale.side_effect = [
+            MagicMock(is_success=True), ConnectionError(),
+            MagicMock(is_success=True),
+        ]
+        response = client.post(url, content_type='application/json',
+                               data=json.dumps({'loads': loads}))
+
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert [result['status'] for result in data['results']] == [
+        'ok', 'error', 'ok']
+    assert [result['charged'] for result in data['results']] == [
+        True, False, True]
+    assert data['results'][1]['errors'] == [
+        {'code': 'http-500', 'message': 'ConnectionError'}]
+    assert Card.query.one().balance == Decimal('40.00')
+
+
+def test_load_cards_batch_charged_not_saved(app, client):
+    """
+    A load that was charged but couldn't be saved is reported as charged, and
+    it still counts towards the compliance limits of the following loads
+    """
+    card = Card.query.one()
+    loads = [
+        {'card_id': card.id, 'amount': '3000.00', 'nonce': 'fake-nonce-1'},
+        {'card_id': card.id, 'amount': '2500.00', 'nonce': 'fake-nonce-2'},
+    ]
+    url = url_for('api.load_cards_batch')
+
+    with patch('limits.api.views.braintree') as braintree_mock, \
+            patch.object(db.session, 'commit', side_effect=OSError()):
+        braintree_mock.Transaction.search.return_value.items = iter([])
+        response = client.post(url, content_type='application/json',
+                               data=json.dumps({'loads': loads}))
+
+    data = json.loads(response.data)
+    assert data['results'][0]['charged'] is True
+    assert data['results'][0]['errors'][0]['code'] == 'charged-not-saved'
+    assert data['results'][1]['charged'] is False
+    assert data['results'][1]['errors'][0]['code'] == 'compliance-1 day'
+    assert braintree_mock.Transaction.sale.call_count == 1
+
+
+@pytest.mark.parametrize('card_id, nonce', [
+    (1, None), (1, ''), (1, ['fake-nonce']), (1, {'nonce': 'fake-nonce'}),
+    (None, 'fake-nonce'), (True, 'fake-nonce'), ([1], 'fake-nonce'),
+])
+def test_load_cards_batch_invalid_item(client, card_id, nonce):
+    """
+    A batch with an invalid Card id or nonce is rejected before loading any
+    Card
+    """
+    card = Card.query.one()
+    loads = [
+        {'card_id': card.id, 'amount': '10.00', 'nonce': 'fake-nonce-1'},
+        {'card_id': card_id, 'amount': '10.00', 'nonce': nonce},
+    ]
+    url = url_for('api.load_cards_batch')
+
+    with patch('limits.api.views.braintree') as braintree_mock:
+        response = client.post(url, content_type='application/json',
+                               data=json.dumps({'loads': loads}))
+
+    assert response.status_code == 400
+    assert braintree_mock.Transaction.sale.call_count == 0
+
+
+@pytest.mark.parametrize('amount', ['NaN', 'sNaN', 'Infinity', '-1.00', '0',
+                                    10.1, 'ten'])
+def test_load_cards_batch_invalid_amount(client, amount):
+    """
+    A batch with an invalid amount is rejected before loading any Card
+    """
+    card = Card.query.one()
+    loads = [
+        {'card_id': card.id, 'amount': '10.00', 'nonce': 'fake-nonce-1'},
+        {'card_id': card.id, 'amount': amount, 'nonce': 'fake-nonce-2'},
+    ]
+    url = url_for('api.load_cards_batch')
+
+    with patch('limits.api.views.braintree') as braintree_mock:
+        response = client.post(url, content_type='application/json',
+                               data=json.dumps({'loads': loads}))
+
+    assert response.status_code == 400
+    assert braintree_mock.Transaction.sale.call_count == 0
+
+
+def test_load_cards_batch_malformed(client):
+    """
+    A malformed batch is rejected as a whole
+    """
+    url = url_for('api.load_cards_batch')
+
+    response = client.post(url, content_type='application/json',
+                           data=json.dumps({'loads': [{'amount': '1.00'}]}))
+
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize('code, cached', [
+    (ErrorCodes.Transaction.PaymentMethodNonceConsumed, True),
+    (ErrorCodes.Transaction.PaymentMethodNonceUnknown, True),
+    (ErrorCodes.Transaction.PaymentMethodNonceLocked, True),
+    (ErrorCodes.Transaction.AmountIsInvalid, False),
+])
+def test_load_card_nonce_validation_error(client, code, cached):
+    """
+    Only the validation errors of a nonce that can't be used again are cached
+    """
+    card_id = Card.query.one().id
+    url = url_for('api.load_card', card_id=card_id)
+
+    with patch('limits.api.views.braintree') as braintree_mock:
+        braintree_mock.Transaction.search.return_value.items = iter([])
+        sale_result = braintree_mock.Transaction.sale.return_value
+        sale_result.is_success = False
+        sale_result.errors.deep_errors = [MagicMock(code=code, message='')]
+
+        responses = [
+            client.post(url, data={'nonce': 'fake-nonce', 'amount': '1'})
+            for _ in range(2)
+        ]
+
+    assert [json.loads(response.data)['errors'][0]['code']
+            for response in responses] == [code, code]
+    assert braintree_mock.Transaction.sale.call_count == (1 if cached else 2)
+
+
+def test_load_card_nonce_gateway_rejected(client):
+    """
+    The errors of a Transaction rejected by the gateway are not cached, it's
+    unknown whether its nonce can be used again
+    """
+    card_id = Card.query.one().id
+    url = url_for('api.load_card', card_id=card_id)
+
+    with patch('limits.api.views.braintree') as braintree_mock:
+        braintree_mock.Transaction.search.return_value.items = iter([])
+        sale_result = braintree_mock.Transaction.sale.return_value
+        sale_result.is_success = False
+        sale_result.errors.deep_errors = []
+        sale_result.transaction.processor_settlement_response_code = ''
+        sale_result.transaction.processor_response_code = ''
+        sale_result.transaction.gateway_rejection_reason = 'duplicate'
+
+        for _ in range(2):
+            client.post(url, data={'nonce': 'fake-nonce', 'amount': '1'})
+
+    assert braintree_mock.Transaction.sale.call_count == 2
+
+
+def test_nonce_cache_bounds():
+    """
+    The nonce cache keeps the most recent nonces and customers only
+    """
+    nonce_cache = NonceCache(max_customers=2, max_nonces=2, timeout=60)
+
+    for nonce in ('nonce-1', 'nonce-2', 'nonce-3'):
+        nonce_cache.set('customer-1', nonce, ['error'])
+    nonce_cache.set('customer-2', 'nonce-1', ['error'])
+    nonce_cache.get('customer-1', 'nonce-2')
+    nonce_cache.set('customer-3', 'nonce-1', ['error'])
+
+    assert nonce_cache.get('customer-1', 'nonce-1') is None
+    assert nonce_cache.get('customer-1', 'nonce-3') == ['error']
+    assert nonce_cache.get('customer-2', 'nonce-1') is None
+    assert nonce_cache.get('customer-3', 'nonce-1') == ['error']
+
+
+def test_nonce_cache_timeout():
+    """
+    The nonces cached expire after a timeout
+    """
+    nonce_cache = NonceCache(max_customers=1, max_nonces=1, timeout=60)
+
+    with patch('limits.api.cache.time.time', return_value=1000):
+        nonce_cache.set('customer-1', 'nonce-1', ['error'])
+    with patch('limits.api.cache.time.time', return_value=1059):
+        assert nonce_cache.get('customer-1', 'nonce-1') == ['error']
+    with patch('limits.api.cache.time.time', return_value=1060):
+        assert nonce_cache.get('customer-1', 'nonce-1') is None
+
+
+def test_load_card_nonce_consumed(client):
+    """
+    A nonce that has already been used is rejected without reaching Braintree
+    """
+    card_id = Card.query.one().id
+    url = url_for('api.load_card', card_id=card_id)
+
+    with patch('limits.api.views.braintree') as braintree_mock:
+        braintree_mock.Transaction.search.return_value.items = []
+        first = client.post(url, data={'nonce': 'fake-nonce', 'amount': '1'})
+        second = client.post(url, data={'nonce': 'fake-nonce', 'amount': '1'})
+
+    assert first.status_code == 200
+    assert second.status_code == 400
+    assert json.loads(second.data)['errors'] == [{
+        'code': ErrorCodes.Transaction.PaymentMethodNonceConsumed,
+        'message': 'Cannot use a payment_method_nonce more than once.',
+    }]
+    assert braintree_mock.Customer.create.call_count == 1
+    assert braintree_mock.Transaction.search.call_count == 1
+    assert braintree_mock.Transaction.sale.call_count == 1
+    assert Card.query.one().balance == Decimal(1)
+
+
+def test_load_card_nonce_declined(client):
+    """
+    A declined nonce gets the same errors back without reaching Braintree
+    """
+    card_id = Card.query.one().id
+    url = url_for('api.load_card', card_id=card_id)
+
+    with patch('limits.api.views.braintree') as braintree_mock:
+        braintree_mock.Transaction.search.return_value.items = []
+        sale_result = braintree_mock.Transaction.sale.return_value
+        sale_result.is_success = False
+        sale_result.errors.deep_errors = []
+        sale_result.transaction.processor_settlement_response_code = ''
+        sale_result.transaction.processor_response_code = '2000'
+        sale_result.transaction.processor_response_text = 'Do Not Honor'
+
+        responses = [
+            client.post(url, data={'nonce': 'fake-nonce', 'amount': '1'})
+            for _ in range(2)
+        ]
+
+    assert [json.loads(response.data) for response in responses] == [
+        {'status': 'error', 'errors': [{'code': '2000',
+                                        'message': 'Do Not Honor'}]},
+    ] * 2
+    assert braintree_mock.Transaction.sale.call_count == 1